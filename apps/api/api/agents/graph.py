@@ -1,4 +1,9 @@
-from typing import Any, Dict, TypedDict, List
+from typing import Any, AsyncIterator, Dict, Tuple, TypedDict, List
+from collections import OrderedDict
+import asyncio
+import copy
+import time
+import unicodedata
 
 from api.agents.nodes import (
     query_understanding_node as q_node,
@@ -6,9 +11,17 @@ from api.agents.nodes import (
     answer_generation_node as a_node,
     source_linking_node as l_node,
 )
+from api.services import db
 from langgraph.graph import StateGraph, START, END
 
 
+PIPELINE_CACHE_SIZE = 512
+PIPELINE_CACHE_TTL = 900  # seconds
+
+_PIPELINE_CACHE: "OrderedDict[Tuple[str, int], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_PIPELINE_PENDING: Dict[Tuple[str, int], asyncio.Event] = {}
+
+
 class GraphState(TypedDict, total=False):
     query: str
     intent: str
@@ -17,6 +30,7 @@ class GraphState(TypedDict, total=False):
     expanded_keywords: List[str]
     results: List[Dict[str, Any]]
     answer: str
+    degraded: bool
     sources: List[Dict[str, Any]]
 
 
@@ -32,16 +46,17 @@ async def _search(state: GraphState) -> GraphState:
     return state
 
 
+# Answer generation and source linking both depend only on the search results, so they
+# run as parallel branches. Each returns just the keys it owns; LangGraph rejects two
+# branches writing the same key in one step.
 async def _answer(state: GraphState) -> GraphState:
     updates = await a_node.run_node(state)  # type: ignore[arg-type]
-    state.update(updates)
-    return state
+    return {"answer": updates.get("answer", ""), "degraded": updates.get("degraded", True)}
 
 
 async def _link(state: GraphState) -> GraphState:
     updates = await l_node.run_node(state)  # type: ignore[arg-type]
-    state.update(updates)
-    return state
+    return {"sources": updates.get("sources", [])}
 
 
 _builder = StateGraph(GraphState)
@@ -52,18 +67,90 @@ _builder.add_node("link_node", _link)
 _builder.add_edge(START, "understand_node")
 _builder.add_edge("understand_node", "search_node")
 _builder.add_edge("search_node", "answer_node")
-_builder.add_edge("answer_node", "link_node")
+_builder.add_edge("search_node", "link_node")
+_builder.add_edge("answer_node", END)
 _builder.add_edge("link_node", END)
 _app = _builder.compile()
 
 
-async def run_pipeline(query: str) -> Dict[str, Any]:
-    initial: GraphState = {"query": query}
-    final_state: GraphState = await _app.ainvoke(initial)
-    return {
-        "answer": final_state.get("answer", ""), 
-        "sources": final_state.get("sources", []),
-        "results": final_state.get("results", [])
-    }
+def _cache_key(query: str) -> Tuple[str, int]:
+    normalized = unicodedata.normalize("NFKC", query).strip().lower()
+    # Ingesting documents bumps the corpus version, which retires older entries
+    return normalized, db.get_corpus_version()
+
 
+def _get_cached(key: Tuple[str, int]) -> Dict[str, Any] | None:
+    entry = _PIPELINE_CACHE.get(key)
+    if entry is None:
+        return None
+    stored_at, result = entry
+    if time.monotonic() - stored_at > PIPELINE_CACHE_TTL:
+        del _PIPELINE_CACHE[key]
+        return None
+    _PIPELINE_CACHE.move_to_end(key)
+    # Callers may mutate the result, so never hand out the cached objects themselves
+    return copy.deepcopy(result)
 
+
+async def run_pipeline(query: str) -> Dict[str, Any]:
+    # Nothing to search for: skip the embedding, Drive and LLM calls entirely
+    if not query.strip():
+        return {"answer": a_node.NO_RESULTS_ANSWER, "sources": [], "results": []}
+    
+    while True:
+        key = _cache_key(query)
+        cached = _get_cached(key)
+        if cached is not None:
+            return cached
+        pending = _PIPELINE_PENDING.get(key)
+        if pending is None:
+            break
+        # The same query is already running; wait for it rather than repeating the LLM call
+        await pending.wait()
+
+    event = asyncio.Event()
+    _PIPELINE_PENDING[key] = event
+    try:
+        initial: GraphState = {"query": query}
+        final_state: GraphState = await _app.ainvoke(initial)
+        result = {
+            "answer": final_state.get("answer", ""), 
+            "sources": final_state.get("sources", []),
+            "results": final_state.get("results", [])
+        }
+        # Fallback or no-results answers usually mean a failed call; let the next request retry
+        if not final_state.get("degraded", True):
+            # Results may have triggered ingestion, so store under the version current now
+            _PIPELINE_CACHE[_cache_key(query)] = (time.monotonic(), copy.deepcopy(result))
+            while len(_PIPELINE_CACHE) > PIPELINE_CACHE_SIZE:
+                _PIPELINE_CACHE.popitem(last=False)
+        return result
+    finally:
+        del _PIPELINE_PENDING[key]
+        event.set()
+
+
+async def stream_pipeline(query: str) -> AsyncIterator[Dict[str, Any]]:
+    """Run the pipeline but stream the answer instead of waiting for the full completion.
+
+    Yields ``{"event": ..., "data": ...}`` items: ``sources`` once retrieval is done,
+    ``token`` for each answer delta, then ``done`` with the full answer.
+    """
+    if not query.strip():
+        yield {"event": "sources", "data": {"sources": [], "results": []}}
+        yield {"event": "token", "data": a_node.NO_RESULTS_ANSWER}
+        yield {"event": "done", "data": {"answer": a_node.NO_RESULTS_ANSWER}}
+        return
+    
+    state: GraphState = {"query": query}
+    state.update(await q_node.run_node(state))  # type: ignore[arg-type]
+    state.update(await s_node.run_node(state))  # type: ignore[arg-type]
+    # Source linking only needs the search results, so send sources before the answer
+    state.update(await l_node.run_node(state))  # type: ignore[arg-type]
+    yield {"event": "sources", "data": {"sources": state.get("sources", []), "results": state.get("results", [])}}
+
+    parts: List[str] = []
+    async for delta in a_node.stream_answer(state):  # type: ignore[arg-type]
+        parts.append(delta)
+        yield {"event": "token", "data": delta}
+    yield {"event": "done", "data": {"answer": "".join(parts)}}
@@ -1,69 +1,355 @@
-from typing import Any, Dict, List
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Tuple
+import asyncio
+import functools
+import hashlib
+import json
 import os
-import openai
+import time
+import numpy as np
 
+from api.services import db
+from api.services.chunking import estimate_tokens
+from api.services.embedding import get_query_embedding
+from api.services.openai_client import create_chat_completion
+from api.services.semantic_cache import SemanticCache
 
-async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
+try:
+    import tiktoken
+except ImportError:
+    # Optional; without it the context is trimmed by an approximate character budget
+    tiktoken = None
+
+
+NO_RESULTS_ANSWER = "I couldn't find relevant information."
+ANSWER_MAX_TOKENS = 1500  # Increased for broader subject queries
+
+# Tokenizer for context budgeting, loaded off the event loop by warm_encoder()
+ENCODER_RETRY_INTERVAL = 300.0
+_ENCODER: Any = None
+_ENCODER_TASK: "asyncio.Task | None" = None
+_ENCODER_RETRY_AT = 0.0
+
+# Exact-match cache of completions, keyed by a hash of the model and prompt
+_ANSWER_CACHE: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+# Paraphrases of a recent query over the same sources reuse its answer; built on
+# first use so its settings come from the loaded .env
+_SEMANTIC_ANSWERS: SemanticCache | None = None
+
+
+# Settings are read on use rather than at import: this module is imported before
+# create_app() loads apps/.env
+def _answer_model() -> str:
+    return os.getenv("ANSWER_MODEL", "gpt-4o-mini")
+
+
+def _max_context_tokens() -> int:
+    # Prompt tokens dominate cost and latency, so cap the context sent with each question
+    return int(os.getenv("ANSWER_MAX_CONTEXT_TOKENS", "6000"))
+
+
+def _answer_cache_size() -> int:
+    return int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+
+
+def _answer_cache_ttl() -> float:
+    return float(os.getenv("ANSWER_CACHE_TTL", "900"))
+
+
+def _semantic_answers() -> SemanticCache:
+    global _SEMANTIC_ANSWERS
+    if _SEMANTIC_ANSWERS is None:
+        _SEMANTIC_ANSWERS = SemanticCache(
+            maxsize=_answer_cache_size(),
+            ttl=_answer_cache_ttl(),
+            threshold=float(os.getenv("ANSWER_SEMANTIC_THRESHOLD", "0.92")),
+        )
+    return _SEMANTIC_ANSWERS
+
+
+def _build_messages(inputs: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Build the chat messages for the answer prompt from search results"""
     results: List[Dict[str, Any]] = inputs.get("results", [])
     query: str = inputs.get("normalized_query") or inputs.get("query") or ""
     is_broad_subject: bool = inputs.get("is_broad_subject", False)
-    expanded_keywords: List[str] = inputs.get("expanded_keywords", [])
     
-    if not results:
-        return {"answer": "I couldn't find relevant information.", "results": []}
+    # Prepare context from search results, as many whole sources as the token budget allows
+    context = _pack_context(results, _max_context_tokens())
+    
+    # Customize system prompt based on query type
+    if is_broad_subject:
+        system_prompt = f"""You are a helpful assistant that provides comprehensive overviews of subjects based on available documents. 
+        
+        The user is asking about a broad subject: "{query}". They want to understand what information is available about this topic.
+        
+        Based on the provided documents, give them:
+        1. A brief overview of what this subject covers
+        2. The main categories/types of information available
+        3. Key topics and areas covered
+        4. A summary of the available resources
+        
+        Be informative but concise. Help them understand the scope and depth of information available."""
+    else:
+        system_prompt = "You are a helpful assistant that provides comprehensive explanations based on the provided context. When given search results, synthesize the information into a clear, well-structured answer that directly addresses the user's query."
+    
+    return [
+        {
+            "role": "system", 
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": f"Query: {query}\n\nContext from documents:\n{context}\n\nPlease provide a comprehensive explanation based on the above context. Structure your answer clearly and cite the sources when relevant."
+        }
+    ]
+
+
+def warm_encoder() -> None:
+    """Start loading the tokenizer in a worker thread (called at app startup).
+
+    The first load may download its BPE file, so it must never run on the event
+    loop. Until it finishes, token counts fall back to a character estimate; a
+    failed load is retried after ENCODER_RETRY_INTERVAL seconds.
+    """
+    global _ENCODER_TASK
+    if tiktoken is None or _ENCODER is not None or time.monotonic() < _ENCODER_RETRY_AT:
+        return
+    if _ENCODER_TASK is not None and not _ENCODER_TASK.done():
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _ENCODER_TASK = loop.create_task(asyncio.to_thread(_load_encoder))
+
+
+def _load_encoder() -> None:
+    global _ENCODER, _ENCODER_RETRY_AT
+    model = _answer_model()
+    try:
+        try:
+            encoder = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Model unknown to this tiktoken version; the gpt-4o family uses o200k_base
+            encoder = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"Error loading tokenizer for {model}: {e}")
+        _ENCODER_RETRY_AT = time.monotonic() + ENCODER_RETRY_INTERVAL
+        return
+    _ENCODER = encoder
+
+
+def _encoder():
+    """The loaded tokenizer, or None while it is unavailable (callers then estimate)"""
+    if _ENCODER is None:
+        warm_encoder()
+    return _ENCODER
+
+
+def _count_tokens(text: str) -> int:
+    """Token count of a prompt fragment"""
+    encoder = _encoder()
+    if encoder is None:
+        return estimate_tokens(text)
+    return _encoded_len(text)
+
+
+@functools.lru_cache(maxsize=10000)
+def _encoded_len(text: str) -> int:
+    # Only exact counts are memoized (the same snippets recur across queries), so
+    # estimates made before the tokenizer loaded don't linger
+    return len(_ENCODER.encode(text))
+
+
+def _estimate_request_tokens(messages: List[Dict[str, str]]) -> int:
+    """Prompt plus completion budget, as charged against the tokens-per-minute limit.
+
+    A character estimate is close enough for throttling, and keeps whole prompts out of
+    the _count_tokens cache.
+    """
+    return sum(estimate_tokens(m["content"]) for m in messages) + ANSWER_MAX_TOKENS
+
+
+def _pack_context(results: List[Dict[str, Any]], budget: int) -> str:
+    """Join sources greedily in rank order, stopping before the one that would exceed the budget"""
+    pieces: List[str] = []
+    used = 0
+    for i, result in enumerate(results, 1):
+        body = f"{result.get('title', 'Unknown Document')}\n{result.get('snippet', '')}\n"
+        piece = f"Source {i}: {body}"
+        # Count the rank prefix and body separately so a snippet's count is reused at any rank
+        # (at most a token off at the seam); +1 for the newline each piece is joined with
+        cost = _count_tokens(f"Source {i}: ") + _count_tokens(body) + 1
+        if used + cost > budget:
+            if not pieces:
+                # Even the top source alone is too long: send as much of it as fits
+                pieces.append(_truncate_tokens(piece, budget))
+            break
+        pieces.append(piece)
+        used += cost
+    return "\n".join(pieces)
+
+
+def _truncate_tokens(text: str, budget: int) -> str:
+    enc = _encoder()
+    if enc is None:
+        # Roughly 4 characters per token, as estimate_tokens assumes
+        return text[:budget * 4]
+    ids = enc.encode(text)
+    if len(ids) <= budget:
+        return text
+    return enc.decode(ids[:budget])
+
+
+def _completion_key(model: str, messages: List[Dict[str, str]]) -> str:
+    payload = json.dumps([model, messages], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _get_cached_answer(key: str) -> str | None:
+    entry = _ANSWER_CACHE.get(key)
+    if entry is None:
+        return None
+    stored_at, answer = entry
+    if time.monotonic() - stored_at > _answer_cache_ttl():
+        del _ANSWER_CACHE[key]
+        return None
+    _ANSWER_CACHE.move_to_end(key)
+    return answer
+
+
+def _store_answer(key: str, answer: str) -> None:
+    _ANSWER_CACHE[key] = (time.monotonic(), answer)
+    _ANSWER_CACHE.move_to_end(key)
+    max_size = _answer_cache_size()
+    while len(_ANSWER_CACHE) > max_size:
+        _ANSWER_CACHE.popitem(last=False)
+
+
+def _sources_key(inputs: Dict[str, Any]) -> str:
+    """Fingerprint of the sources (and prompt style) an answer was generated from"""
+    # Include the snippet head so a re-ingested chunk with new text doesn't reuse a stale answer
+    parts = [
+        f"{r.get('chunk_id') or r.get('url') or r.get('title', '')}:{(r.get('snippet') or '')[:64]}"
+        for r in inputs.get("results", [])
+    ]
+    parts.append("broad" if inputs.get("is_broad_subject") else "specific")
+    return hashlib.blake2b("\x1f".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+async def _lookup_answer(inputs: Dict[str, Any], key: str) -> Tuple[str | None, np.ndarray | None]:
+    """Return (cached answer, query embedding): exact prompt match first, then a paraphrase"""
+    cached = _get_cached_answer(key)
+    if cached is not None:
+        return cached, None
+    query = inputs.get("normalized_query") or inputs.get("query") or ""
+    try:
+        # Usually already cached by the search node, so this costs no API call
+        q_vec = await get_query_embedding(query)
+    except Exception as e:
+        print(f"Error embedding query for answer cache: {e}")
+        return None, None
+    hit = _semantic_answers().lookup(q_vec, db.get_corpus_version())
+    if hit is not None and hit[0] == _sources_key(inputs):
+        return hit[1], q_vec
+    return None, q_vec
+
+
+def _remember_answer(inputs: Dict[str, Any], key: str, q_vec: np.ndarray | None, answer: str) -> None:
+    _store_answer(key, answer)
+    if q_vec is not None:
+        _semantic_answers().store(q_vec, (_sources_key(inputs), answer), db.get_corpus_version())
+
+
+def _fallback_answer(inputs: Dict[str, Any]) -> str:
+    """Simple concatenation of snippets used when the LLM call fails"""
+    results: List[Dict[str, Any]] = inputs.get("results", [])
+    query: str = inputs.get("normalized_query") or inputs.get("query") or ""
+    snippets = [r.get("snippet", "") for r in results]  # Remove the [:3] limit
+    return f"Based on the search results for '{query}':\n\n" + "\n\n".join(snippets)
+
+
+async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = inputs.get("results", [])
     
-    # Prepare context from search results
-    context_parts = []
-    for i, result in enumerate(results, 1):  # Remove the [:5] limit to use all results
-        title = result.get("title", "Unknown Document")
-        snippet = result.get("snippet", "")
-        context_parts.append(f"Source {i}: {title}\n{snippet}\n")
+    if not results:
+        # Retrieval may have failed rather than found nothing, so don't let callers cache this
+        return {"answer": NO_RESULTS_ANSWER, "results": [], "degraded": True}
     
-    context = "\n".join(context_parts)
+    model = _answer_model()
+    messages = _build_messages(inputs)
+    key = _completion_key(model, messages)
+    cached, q_vec = await _lookup_answer(inputs, key)
+    if cached is not None:
+        return {"answer": cached, "results": results, "degraded": False}
     
     # Generate a comprehensive answer using OpenAI
     try:
-        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
-        # Customize system prompt based on query type
-        if is_broad_subject:
-            system_prompt = f"""You are a helpful assistant that provides comprehensive overviews of subjects based on available documents. 
-            
-            The user is asking about a broad subject: "{query}". They want to understand what information is available about this topic.
-            
-            Based on the provided documents, give them:
-            1. A brief overview of what this subject covers
-            2. The main categories/types of information available
-            3. Key topics and areas covered
-            4. A summary of the available resources
-            
-            Be informative but concise. Help them understand the scope and depth of information available."""
-        else:
-            system_prompt = "You are a helpful assistant that provides comprehensive explanations based on the provided context. When given search results, synthesize the information into a clear, well-structured answer that directly addresses the user's query."
-        
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": f"Query: {query}\n\nContext from documents:\n{context}\n\nPlease provide a comprehensive explanation based on the above context. Structure your answer clearly and cite the sources when relevant."
-                }
-            ],
-            max_tokens=1500,  # Increased for broader subject queries
+        response = await create_chat_completion(
+            _estimate_request_tokens(messages),
+            model=model,
+            messages=messages,
+            max_tokens=ANSWER_MAX_TOKENS,
             temperature=0.7
         )
         
         answer = response.choices[0].message.content
+        degraded = not answer
+        if answer:
+            _remember_answer(inputs, key, q_vec, answer)
     except Exception as e:
         print(f"Error generating answer with LLM: {e}")
         # Fallback to simple concatenation
-        snippets = [r.get("snippet", "") for r in results]  # Remove the [:3] limit
-        answer = f"Based on the search results for '{query}':\n\n" + "\n\n".join(snippets)
+        answer = _fallback_answer(inputs)
+        degraded = True
     
-    return {"answer": answer, "results": results}
+    # degraded marks fallback/empty answers, which must not be cached downstream
+    return {"answer": answer, "results": results, "degraded": degraded}
 
 
+async def stream_answer(inputs: Dict[str, Any]) -> AsyncIterator[str]:
+    """Yield the answer piece by piece as the LLM generates it"""
+    results: List[Dict[str, Any]] = inputs.get("results", [])
+    
+    if not results:
+        yield NO_RESULTS_ANSWER
+        return
+    
+    model = _answer_model()
+    messages = _build_messages(inputs)
+    key = _completion_key(model, messages)
+    cached, q_vec = await _lookup_answer(inputs, key)
+    if cached is not None:
+        yield cached
+        return
+    
+    parts: List[str] = []
+    streamed_any = False
+    try:
+        response = await create_chat_completion(
+            _estimate_request_tokens(messages),
+            model=model,
+            messages=messages,
+            max_tokens=ANSWER_MAX_TOKENS,
+            temperature=0.7,
+            stream=True
+        )
+        
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                streamed_any = True
+                parts.append(delta)
+                yield delta
+        # Only complete, non-empty streams are cached; a dropped connection leaves a
+        # partial answer, and a filtered/empty completion would be replayed as ""
+        if parts:
+            _remember_answer(inputs, key, q_vec, "".join(parts))
+    except Exception as e:
+        print(f"Error streaming answer with LLM: {e}")
+        # Only fall back if nothing reached the client yet, otherwise the answer would be garbled
+        if not streamed_any:
+            yield _fallback_answer(inputs)
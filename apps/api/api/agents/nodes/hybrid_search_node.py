@@ -1,14 +1,21 @@
 from typing import Any, Dict, List
+import asyncio
 import hashlib
+import heapq
 import os
 from api.services import db
 from api.services.db import get_supabase_client
-from api.services.embedding import embed_texts
+from api.services.chunking import chunk_text, estimate_tokens
+from api.services.embedding import embed_texts_async, get_query_embedding
 from api.integrations.mcp_client import GDriveMCPClient
 import numpy as np
 
 
 TOP_K = 100
+MAX_CONCURRENT_FILES = 8
+
+_SOURCE_ID_CACHE: Dict[str, Any] = {}
+_SOURCE_ID_LOCK = asyncio.Lock()
 
 
 async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
@@ -18,20 +25,34 @@ async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
     
     print(f"Searching with normalized query: '{query}'")
     
+    # Start the Drive listing right away so it overlaps with embedding and the DB search;
+    # it is only awaited if the database doesn't have enough results on its own
+    client = GDriveMCPClient()
+    drive_task = asyncio.create_task(client.list_files(query=query))
+    
+    # Embed the query once (cached across requests) and reuse it for every scoring step
+    try:
+        query_embedding = await get_query_embedding(query)
+    except Exception as e:
+        print(f"Error embedding query: {e}")
+        drive_task.cancel()
+        return {"results": []}
+    
     # Step 1: First try to search the database for existing content
-    db_results = await search_database(query)
+    db_results = await search_database(query_embedding)
     print(f"Found {len(db_results)} results in database")
     
     # Step 2: Search Google Drive for files matching the query (only if we have few DB results)
     drive_files = []
     if len(db_results) < 3:  # Only search Drive if we don't have enough DB results
-        client = GDriveMCPClient()
         try:
-            drive_files = await client.list_files(query=query)
+            drive_files = await drive_task
             print(f"Found {len(drive_files)} files in Google Drive matching '{query}'")
         except Exception as e:
             print(f"Error searching Google Drive: {e}")
             drive_files = []
+    else:
+        drive_task.cancel()
     
     if not drive_files and not db_results:
         return {"results": []}
@@ -44,6 +65,7 @@ async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
         existing_files = await check_existing_files(file_ids)
         
         print(f"Found {len(existing_files)} existing files in database out of {len(drive_files)} total files")
+        pending_files = []
         for file_info in drive_files:
             file_id = file_info.get("id")
             if not file_id:
@@ -51,55 +73,88 @@ async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
                 
             # Check if file exists in database and is up-to-date
             if file_id in existing_files:
-                existing_file = existing_files[file_id]
                 print(f"File {file_info.get('name', 'Unknown')} already exists in database, skipping")
                 # Check if file was updated (you could compare timestamps here)
                 # For now, we'll assume existing files are up-to-date
                 continue
-            
-            # Process new file
+            pending_files.append(file_info)
+        
+        # Process new files concurrently, bounded so a large Drive listing doesn't
+        # flood Drive, Supabase and OpenAI at once
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_FILES)
+        
+        async def _stage(file_info: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                try:
+                    print(f"Processing new file: {file_info.get('name', 'Unknown')}")
+                    staged_file = await stage_new_file(client, file_info)
+                    if not staged_file:
+                        print(f"Failed to process file: {file_info.get('name', 'Unknown')}")
+                    return staged_file
+                except Exception as e:
+                    print(f"Error processing file {file_info.get('id')}: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    return None
+        
+        staged = await asyncio.gather(*(_stage(f) for f in pending_files))
+        staged_files = [f for f in staged if f and f["chunks"]]
+        
+        # Embed the chunks of every new file together instead of one request per file
+        if staged_files:
+            all_texts = [chunk["text"] for f in staged_files for chunk in f["chunks"]]
+            print(f"Generating embeddings for {len(all_texts)} chunks across {len(staged_files)} files...")
             try:
-                print(f"Processing new file: {file_info.get('name', 'Unknown')}")
-                processed_file = await process_new_file(client, file_info)
-                if processed_file:
-                    print(f"Successfully processed file: {file_info.get('name', 'Unknown')}")
-                    new_files.append(processed_file)
-                else:
-                    print(f"Failed to process file: {file_info.get('name', 'Unknown')}")
+                all_embeddings = await embed_texts_async(all_texts)
             except Exception as e:
-                print(f"Error processing file {file_id}: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
+                print(f"Error generating embeddings for new files: {e}")
+                all_embeddings = []
+            
+            if not all_embeddings:
+                # Nothing was stored for these files; drop their rows so the next search retries them
+                await asyncio.gather(*(discard_staged_file(f) for f in staged_files))
+            else:
+                offset = 0
+                store_tasks = []
+                for staged_file in staged_files:
+                    count = len(staged_file["chunks"])
+                    store_tasks.append(store_embeddings(staged_file, all_embeddings[offset:offset + count]))
+                    offset += count
+                stored = await asyncio.gather(*store_tasks)
+                new_files = [f for f in stored if f]
+                if new_files:
+                    db.bump_corpus_version()
+                for f in new_files:
+                    print(f"Successfully processed file: {f['title']}")
     
     # Step 4: Add results from newly processed files
     new_results = []
     if new_files:
-        # Generate query embedding once
-        query_embedding = np.array(embed_texts([query])[0], dtype=float)
-        
-        for file_data in new_files:
-            if file_data.get("chunks"):
-                for chunk in file_data["chunks"]:
-                    # Calculate similarity score
-                    chunk_embedding = np.array(chunk["embedding"], dtype=float)
-                    score = cosine_similarity(query_embedding, chunk_embedding)
-                    
-                    new_results.append({
-                        "chunk_id": chunk["id"],
-                        "title": file_data["title"],
-                        "url": file_data["url"],
-                        "snippet": chunk["text"][:300],
-                        "score": score,
-                    })
+        new_chunks = [(file_data, chunk) for file_data in new_files for chunk in file_data.get("chunks", [])]
+        if new_chunks:
+            # Embeddings are unit-length, so one matmul gives every cosine similarity
+            matrix = np.asarray([chunk["embedding"] for _, chunk in new_chunks], dtype=np.float32)
+            scores = matrix @ query_embedding
+            for (file_data, chunk), score in zip(new_chunks, scores):
+                new_results.append({
+                    "chunk_id": chunk["id"],
+                    "title": file_data["title"],
+                    "url": file_data["url"],
+                    "text": chunk["text"],
+                    "score": float(score),
+                })
     
-    # Combine all results and sort by score
+    # Combine all results and keep the TOP_K best by score
     all_results = db_results + new_results
-    all_results.sort(key=lambda x: x["score"], reverse=True)
+    top_results = heapq.nlargest(TOP_K, all_results, key=lambda x: x["score"])
     
     print(f"Total results: {len(all_results)} (DB: {len(db_results)}, New: {len(new_results)})")
     
-    return {"results": all_results[:TOP_K]}
+    # Results carry the full chunk text until the final cut; only build snippets for survivors
+    for result in top_results:
+        result["snippet"] = result.pop("text")[:300]
+    
+    return {"results": top_results}
 
 
 async def check_existing_files(file_ids: List[str]) -> Dict[str, Any]:
@@ -110,7 +165,9 @@ async def check_existing_files(file_ids: List[str]) -> Dict[str, Any]:
     try:
         # Use Supabase client directly
         db_client = get_supabase_client()
-        result = db_client.table('documents').select('drive_file_id, title, url, updated_at').in_('drive_file_id', file_ids).execute()
+        result = await db.run_query(
+            db_client.table('documents').select('drive_file_id, title, url, updated_at').in_('drive_file_id', file_ids)
+        )
         
         existing = {}
         for row in result.data:
@@ -125,8 +182,33 @@ async def check_existing_files(file_ids: List[str]) -> Dict[str, Any]:
         return {}
 
 
-async def process_new_file(client: GDriveMCPClient, file_info: Dict[str, Any]) -> Dict[str, Any]:
-    """Process a new file from Google Drive and store it in the database"""
+async def get_source_id(db_client: Any, provider: str, name: str) -> Any:
+    """Return the id of the source row for a provider, creating it on first use.
+
+    The id never changes once created, so it is cached for the life of the process.
+    """
+    if provider in _SOURCE_ID_CACHE:
+        return _SOURCE_ID_CACHE[provider]
+    
+    # Files are staged concurrently; serialize misses so only one caller inserts the row
+    async with _SOURCE_ID_LOCK:
+        if provider not in _SOURCE_ID_CACHE:
+            source_result = await db.run_query(db_client.table('sources').select('id').eq('provider', provider))
+            if not source_result.data:
+                source_result = await db.run_query(db_client.table('sources').insert({
+                    'provider': provider,
+                    'name': name
+                }))
+            _SOURCE_ID_CACHE[provider] = source_result.data[0]['id']
+    return _SOURCE_ID_CACHE[provider]
+
+
+async def stage_new_file(client: GDriveMCPClient, file_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Download a new file from Google Drive and store its document and chunk rows.
+
+    Embeddings are generated separately so that chunks from several files can share
+    one embedding request; see store_embeddings.
+    """
     file_id = file_info.get("id")
     title = file_info.get("name", "Unknown")
     url = file_info.get("webViewLink", "")
@@ -148,23 +230,17 @@ async def process_new_file(client: GDriveMCPClient, file_info: Dict[str, Any]) -
         db_client = get_supabase_client()
         
         # Ensure source exists
-        source_result = db_client.table('sources').select('id').eq('provider', 'gdrive').execute()
-        if not source_result.data:
-            source_result = db_client.table('sources').insert({
-                'provider': 'gdrive',
-                'name': 'Google Drive'
-            }).execute()
-        source_id = source_result.data[0]['id']
+        source_id = await get_source_id(db_client, 'gdrive', 'Google Drive')
         
         # Insert document
-        doc_result = db_client.table('documents').insert({
+        doc_result = await db.run_query(db_client.table('documents').insert({
             'source_id': source_id,
             'title': title,
             'mime_type': mime_type,
             'drive_file_id': file_id,
             'url': url,
             'checksum': checksum
-        }).execute()
+        }))
         
         if not doc_result.data:
             print(f"Failed to insert document {file_id}")
@@ -173,58 +249,39 @@ async def process_new_file(client: GDriveMCPClient, file_info: Dict[str, Any]) -
         document_id = doc_result.data[0]['id']
         
         # Create chunks
-        chunk_size = 2000
-        overlap = 200
-        chunks = []
-        i = 0
-        while i < len(text):
-            chunks.append(text[i : i + chunk_size])
-            i += chunk_size - overlap
+        chunks = chunk_text(text)
         
-        # Insert chunks
-        db_client.table('chunks').delete().eq('document_id', document_id).execute()
-        
-        chunk_data = []
-        for idx, chunk_text in enumerate(chunks):
-            chunk_result = db_client.table('chunks').insert({
+        # The document row is new, so its chunks can be inserted directly
+        chunk_rows = [
+            {
                 'document_id': document_id,
                 'chunk_index': idx,
-                'text': chunk_text,
-                'token_count': len(chunk_text.split())
-            }).execute()
-            
-            if chunk_result.data:
-                chunk_data.append({
-                    'id': chunk_result.data[0]['id'],
-                    'text': chunk_text
-                })
+                'text': chunk,
+                'token_count': estimate_tokens(chunk)
+            }
+            for idx, chunk in enumerate(chunks)
+        ]
+        try:
+            chunk_result = await db.run_query(db_client.table('chunks').insert(chunk_rows)) if chunk_rows else None
+        except Exception as e:
+            print(f"Error inserting chunks for file {file_id}: {e}")
+            await discard_staged_file({"file_id": file_id, "document_id": document_id})
+            return None
         
-        # Generate embeddings in batches
-        if chunk_data:
-            print(f"Generating embeddings for {len(chunk_data)} chunks...")
-            embeddings = embed_texts([chunk['text'] for chunk in chunk_data])
-            
-            # Insert embeddings
-            db_client.table('embeddings').delete().in_('chunk_id', [chunk['id'] for chunk in chunk_data]).execute()
-            
-            # Batch insert embeddings
-            embedding_data = []
-            for chunk, embedding in zip(chunk_data, embeddings):
-                embedding_data.append({
-                    'chunk_id': chunk['id'],
-                    'embedding': embedding,
-                    'model': os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+        chunk_data = []
+        if chunk_result and chunk_result.data:
+            for row in sorted(chunk_result.data, key=lambda r: r['chunk_index']):
+                chunk_data.append({
+                    'id': row['id'],
+                    'text': row['text']
                 })
-            
-            # Insert all embeddings at once
-            db_client.table('embeddings').insert(embedding_data).execute()
-            print(f"Successfully inserted {len(embedding_data)} embeddings")
         
         return {
+            "file_id": file_id,
+            "document_id": document_id,
             "title": title,
             "url": url,
-            "chunks": [{"id": chunk['id'], "text": chunk['text'], "embedding": emb} 
-                      for chunk, emb in zip(chunk_data, embeddings)]
+            "chunks": chunk_data
         }
         
     except Exception as e:
@@ -234,52 +291,109 @@ async def process_new_file(client: GDriveMCPClient, file_info: Dict[str, Any]) -
         return None
 
 
-async def search_database(query: str) -> List[Dict[str, Any]]:
-    """Search the database for relevant chunks"""
+async def store_embeddings(staged_file: Dict[str, Any], embeddings: List[List[float]]) -> Dict[str, Any]:
+    """Store the embeddings for a staged file's chunks and attach them to the chunks"""
+    chunk_data = staged_file["chunks"]
     try:
-        # Generate query embedding
-        query_embedding = np.array(embed_texts([query])[0], dtype=float)
-        
-        with db.get_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    select e.chunk_id, e.embedding, d.title, d.url, c.text
-                    from embeddings e
-                    join chunks c on c.id = e.chunk_id
-                    join documents d on d.id = c.document_id
-                    limit 2000
-                """)
-                rows = cur.fetchall()
+        db_client = get_supabase_client()
         
-        results = []
-        for r in rows:
-            # Handle both string and list formats for embeddings
-            embedding = r["embedding"]
-            if isinstance(embedding, str):
-                import json
-                try:
-                    emb = np.array(json.loads(embedding), dtype=float)
-                except (json.JSONDecodeError, ValueError):
-                    continue
-            else:
-                emb = np.array(embedding, dtype=float)
-            
-            score = cosine_similarity(query_embedding, emb)
-            results.append({
-                "chunk_id": r["chunk_id"],
-                "title": r["title"],
-                "url": r["url"],
-                "snippet": r["text"][:300],
-                "score": score,
+        # Batch insert embeddings
+        embedding_data = []
+        for chunk, embedding in zip(chunk_data, embeddings):
+            embedding_data.append({
+                'chunk_id': chunk['id'],
+                'embedding': embedding,
+                'model': os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
             })
         
-        return results
+        # Insert all embeddings at once; the chunks were just created, so none exist yet
+        await db.run_query(db_client.table('embeddings').insert(embedding_data))
+        print(f"Successfully inserted {len(embedding_data)} embeddings")
+        
+        return {
+            "title": staged_file["title"],
+            "url": staged_file["url"],
+            "chunks": [{"id": chunk['id'], "text": chunk['text'], "embedding": emb} 
+                      for chunk, emb in zip(chunk_data, embeddings)]
+        }
+        
+    except Exception as e:
+        print(f"Error storing embeddings for file {staged_file.get('file_id')}: {e}")
+        import traceback
+        traceback.print_exc()
+        await discard_staged_file(staged_file)
+        return None
+
+
+async def discard_staged_file(staged_file: Dict[str, Any]) -> None:
+    """Delete a staged file's chunk and document rows after a failed write.
+
+    check_existing_files treats any document row as already ingested, so a row left
+    behind without embeddings would keep the file out of the index for good.
+    """
+    document_id = staged_file.get("document_id")
+    if document_id is None:
+        return
+    try:
+        db_client = get_supabase_client()
+        await db.run_query(db_client.table('chunks').delete().eq('document_id', document_id))
+        await db.run_query(db_client.table('documents').delete().eq('id', document_id))
+    except Exception as e:
+        print(f"Error discarding staged file {staged_file.get('file_id')}: {e}")
+
+
+async def search_database(query_embedding: np.ndarray) -> List[Dict[str, Any]]:
+    """Search the database for relevant chunks"""
+    try:
+        # Prefer the pgvector index; fall back to scoring in Python if the
+        # match_chunks function has not been installed yet. Both talk to Supabase
+        # synchronously, so run them off the event loop.
+        results = await asyncio.to_thread(vector_search_database, query_embedding)
+        if results:
+            return results
+        return await asyncio.to_thread(scan_search_database, query_embedding)
     except Exception as e:
         print(f"Error searching database: {e}")
         return []
 
 
-def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
-    """Calculate cosine similarity between two vectors"""
-    denom = (np.linalg.norm(a) * np.linalg.norm(b))
-    return float(np.dot(a, b) / denom) if denom != 0 else 0.0
+def vector_search_database(query_embedding: np.ndarray) -> List[Dict[str, Any]]:
+    """Let pgvector rank chunks by cosine distance and return only the TOP_K rows"""
+    return db.match_chunks(query_embedding, TOP_K)
+
+
+def scan_search_database(query_embedding: np.ndarray) -> List[Dict[str, Any]]:
+    """Score stored embeddings in Python when the pgvector search is unavailable"""
+    with db.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                select e.chunk_id, e.embedding, d.title, d.url, c.text
+                from embeddings e
+                join chunks c on c.id = e.chunk_id
+                join documents d on d.id = c.document_id
+                limit 2000
+            """)
+            rows = cur.fetchall()
+    
+    # Parse every stored embedding in one pass into a single matrix
+    matrix, kept = db.parse_vectors([r["embedding"] for r in rows], query_embedding.shape[0])
+    if not kept:
+        return []
+    kept_rows = [rows[i] for i in kept]
+    
+    # Stored embeddings and the query are unit-length, so one matmul gives every cosine score
+    scores = matrix @ query_embedding
+    
+    # Only the TOP_K best rows can survive the final cut, so avoid a full sort
+    results = []
+    for idx in db.top_k_indices(scores, TOP_K):
+        r = kept_rows[idx]
+        results.append({
+            "chunk_id": r["chunk_id"],
+            "title": r["title"],
+            "url": r["url"],
+            "text": r["text"],
+            "score": float(scores[idx]),
+        })
+    
+    return results
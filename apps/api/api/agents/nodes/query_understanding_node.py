@@ -1,47 +1,71 @@
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
+import functools
 import re
 
 
+_WORD_RE = re.compile(r'\b\w+\b')
+
+# Common question words and phrases that carry no search meaning
+_STOP_WORDS = frozenset({
+    "can", "you", "please", "list", "all", "the", "files", "related", "to",
+    "show", "me", "find", "search", "for", "about", "what", "is", "are",
+    "how", "do", "does", "will", "would", "could", "should", "may", "might",
+    "tell", "give", "get", "help", "assist", "with", "regarding", "concerning",
+    "information", "resources", "documents", "data", "content"
+})
+
+# Intent and broad-subject triggers
+_INTENT_SEARCH = frozenset({"list", "show", "find", "search"})
+_INTENT_QA = frozenset({"what", "how", "why", "when", "where"})
+_BROAD_TRIGGERS = frozenset({"what", "show", "list", "find"})
+# Matched as substrings of the query, so derived forms ("guidelines", "manually",
+# "documentation") keep counting as specific
+_SPECIFIC_STEMS = ("cdss", "implementation", "guide", "manual", "document")
+
+# Subject expansion for better search coverage (immutable, shared across requests)
+_SUBJECT_EXPANSIONS = {
+    "health": ("healthcare", "medical", "clinical", "patient", "hospital"),
+    "healthcare": ("health", "medical", "clinical", "patient", "hospital"),
+    "medical": ("health", "healthcare", "clinical", "patient", "hospital"),
+    "clinical": ("health", "healthcare", "medical", "patient", "hospital"),
+    "ai": ("artificial intelligence", "machine learning", "ml", "automation"),
+    "artificial": ("ai", "intelligence", "machine learning", "ml"),
+    "intelligence": ("ai", "artificial", "machine learning", "ml"),
+    "data": ("analytics", "analysis", "insights", "metrics"),
+    "analytics": ("data", "analysis", "insights", "metrics"),
+    "business": ("enterprise", "corporate", "organization", "company"),
+    "technology": ("tech", "technical", "system", "platform"),
+    "system": ("platform", "technology", "tech", "solution")
+}
+_EXPANSION_CLOSURE = {k: frozenset([k, *v]) for k, v in _SUBJECT_EXPANSIONS.items()}
+
+
 async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
     query = inputs.get("query", "").strip()
-    
-    # Extract meaningful keywords from the query
-    # Remove common question words and phrases
-    stop_words = {
-        "can", "you", "please", "list", "all", "the", "files", "related", "to",
-        "show", "me", "find", "search", "for", "about", "what", "is", "are",
-        "how", "do", "does", "will", "would", "could", "should", "may", "might",
-        "tell", "give", "get", "help", "assist", "with", "regarding", "concerning",
-        "information", "resources", "documents", "data", "content"
+    intent, normalized_query, is_broad_subject, expanded_keywords = _understand_query(query)
+    return {
+        "intent": intent, 
+        "normalized_query": normalized_query,
+        "original_query": query,
+        "is_broad_subject": is_broad_subject,
+        "expanded_keywords": list(expanded_keywords)
     }
+
+
+@functools.lru_cache(maxsize=4096)
+def _understand_query(query: str) -> Tuple[str, str, bool, Tuple[str, ...]]:
+    """Pure query analysis, memoized since retries and refreshes resubmit the same query"""
+    query_lower = query.lower()
     
-    # Convert to lowercase and split into words
-    words = re.findall(r'\b\w+\b', query.lower())
+    # Extract meaningful keywords from the query
+    words = _WORD_RE.findall(query_lower)
+    word_set = set(words)
     
     # Filter out stop words and keep only meaningful terms
-    keywords = [word for word in words if word not in stop_words and len(word) > 2]
-    
-    # Subject expansion for better search coverage
-    subject_expansions = {
-        "health": ["healthcare", "medical", "clinical", "patient", "hospital"],
-        "healthcare": ["health", "medical", "clinical", "patient", "hospital"],
-        "medical": ["health", "healthcare", "clinical", "patient", "hospital"],
-        "clinical": ["health", "healthcare", "medical", "patient", "hospital"],
-        "ai": ["artificial intelligence", "machine learning", "ml", "automation"],
-        "artificial": ["ai", "intelligence", "machine learning", "ml"],
-        "intelligence": ["ai", "artificial", "machine learning", "ml"],
-        "data": ["analytics", "analysis", "insights", "metrics"],
-        "analytics": ["data", "analysis", "insights", "metrics"],
-        "business": ["enterprise", "corporate", "organization", "company"],
-        "technology": ["tech", "technical", "system", "platform"],
-        "system": ["platform", "technology", "tech", "solution"]
-    }
+    keywords = [word for word in words if word not in _STOP_WORDS and len(word) > 2]
     
-    # Expand keywords with related terms
-    expanded_keywords = set(keywords)
-    for keyword in keywords:
-        if keyword in subject_expansions:
-            expanded_keywords.update(subject_expansions[keyword])
+    # Expand keywords with related terms (each keyword maps to itself plus its expansions)
+    expanded_keywords = set().union(*(_EXPANSION_CLOSURE.get(k, (k,)) for k in keywords))
     
     # If no keywords found, use the original query
     if not keywords:
@@ -52,24 +76,17 @@ async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
     
     # Determine intent based on query patterns
     intent = "qa"
-    if any(word in query.lower() for word in ["list", "show", "find", "search"]):
+    if word_set & _INTENT_SEARCH:
         intent = "search"
-    elif any(word in query.lower() for word in ["what", "how", "why", "when", "where"]):
+    elif word_set & _INTENT_QA:
         intent = "qa"
     
     # Detect if this is a broad subject query (asking for overview)
     is_broad_subject = (
         len(keywords) <= 2 and 
-        any(word in query.lower() for word in ["what", "show", "list", "find"]) and
-        not any(specific in query.lower() for specific in ["cdss", "implementation", "guide", "manual", "document"])
+        bool(word_set & _BROAD_TRIGGERS) and
+        not any(stem in query_lower for stem in _SPECIFIC_STEMS)
     )
     
-    return {
-        "intent": intent, 
-        "normalized_query": normalized_query,
-        "original_query": query,
-        "is_broad_subject": is_broad_subject,
-        "expanded_keywords": list(expanded_keywords)
-    }
-
-
+    # Cached results are shared, so hand back only immutable values
+    return intent, normalized_query, is_broad_subject, tuple(expanded_keywords)
@@ -1,21 +1,95 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
+import os
 
 from api.services import db
-from api.services.embedding import embed_texts
+from api.services.embedding import get_query_embedding
+from api.services.semantic_cache import SemanticCache
 import numpy as np
 
 
 TOP_K = 5
+SCAN_BATCH_SIZE = 256
+EMBEDDING_DIM = 1536
+
+# Parsed embeddings from the last full scan, reused until the table changes
+_MATRIX_CACHE: Dict[str, Any] = {"stamp": None, "matrix": None, "meta": None}
+
+# Built on first use, so the SEMANTIC_CACHE_* settings come from the loaded .env
+_RESULT_CACHE: SemanticCache | None = None
+
+
+def _result_cache() -> SemanticCache:
+    global _RESULT_CACHE
+    if _RESULT_CACHE is None:
+        _RESULT_CACHE = SemanticCache(
+            maxsize=int(os.getenv("SEMANTIC_CACHE_SIZE", "256")),
+            ttl=float(os.getenv("SEMANTIC_CACHE_TTL", "900")),
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        )
+    return _RESULT_CACHE
+
+
+def _ranked_in_db(q_vec: np.ndarray) -> List[Dict[str, Any]]:
+    return [
+        {
+            "chunk_id": r["chunk_id"],
+            "title": r["title"],
+            "url": r["url"],
+            "snippet": r["text"][:300],
+            "score": r["score"],
+        }
+        for r in db.match_chunks(q_vec, TOP_K)
+    ]
 
 
 async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
     query = inputs.get("normalized_query") or inputs.get("query")
     if not query:
         return {"results": []}
-    # Embed query and compute cosine similarity in Python vs stored vectors
-    q_vec = np.array(embed_texts([query])[0], dtype=float)
+    # Shared LRU of query embeddings; the returned array is cached, so never modify it in place
+    q_vec = await get_query_embedding(query)
+    # Paraphrases of a recent query reuse its results, until new documents are ingested
+    version = db.get_corpus_version()
+    cache = _result_cache()
+    cached = cache.lookup(q_vec, version)
+    if cached is not None:
+        return {"results": [dict(r) for r in cached]}
+    results = _search(q_vec)
+    # An empty list may mean a DB/RPC failure, so only successful searches are reused
+    if results:
+        cache.store(q_vec, [dict(r) for r in results], version)
+    return {"results": results}
+
+
+def _search(q_vec: np.ndarray) -> List[Dict[str, Any]]:
+    # Let pgvector rank by cosine distance; only fall back to scoring in numpy
+    # when the match_chunks function isn't installed
+    ranked = _ranked_in_db(q_vec)
+    if ranked:
+        return ranked
+    matrix, meta = _load_matrix()
+    if not meta:
+        return []
+    # Stored embeddings and the query are unit-length float32 (see embed_texts),
+    # so the matmul yields cosine similarities with no per-request normalization
+    scores = matrix @ q_vec
+    top_idx = db.top_k_indices(scores, TOP_K)
+    return [{**meta[idx], "score": float(scores[idx])} for idx in top_idx]
+
+
+def _load_matrix() -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    """Return the parsed embedding matrix and row metadata, reusing the cached copy
+    while the embeddings table hasn't changed."""
+    stamp = _embeddings_stamp()
+    if stamp is not None and _MATRIX_CACHE["stamp"] == stamp:
+        return _MATRIX_CACHE["matrix"], _MATRIX_CACHE["meta"]
+    
+    # Stream candidate rows in batches so only one batch of raw rows is held at a time
+    blocks: List[np.ndarray] = []
+    meta: List[Dict[str, Any]] = []
     with db.get_connection() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor(name="search_stream") as cur:
+            cur.itersize = SCAN_BATCH_SIZE
             cur.execute(
                 """
                 select e.chunk_id, e.embedding, d.title, d.url, c.text
@@ -25,34 +99,38 @@ async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
                 limit 2000
                 """
             )
-            rows = cur.fetchall()
-    def cosine(a: np.ndarray, b: np.ndarray) -> float:
-        denom = (np.linalg.norm(a) * np.linalg.norm(b))
-        return float(np.dot(a, b) / denom) if denom != 0 else 0.0
-    scored = []
-    for r in rows:
-        # Handle both string and list formats for embeddings
-        embedding = r["embedding"]
-        if isinstance(embedding, str):
-            # Parse string representation of array
-            import json
-            try:
-                emb = np.array(json.loads(embedding), dtype=float)
-            except (json.JSONDecodeError, ValueError):
-                # If parsing fails, skip this embedding
-                continue
-        else:
-            emb = np.array(embedding, dtype=float)
-        
-        score = cosine(q_vec, emb)
-        scored.append({
-            "chunk_id": r["chunk_id"],
-            "title": r["title"],
-            "url": r["url"],
-            "snippet": r["text"][:300],
-            "score": score,
-        })
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return {"results": scored[:TOP_K]}
+            while True:
+                rows = cur.fetchmany(SCAN_BATCH_SIZE)
+                if not rows:
+                    break
+                # Handles both pgvector text and list formats for embeddings
+                block, kept = db.parse_vectors([r["embedding"] for r in rows], EMBEDDING_DIM)
+                blocks.append(block)
+                meta.extend(
+                    {
+                        "chunk_id": rows[i]["chunk_id"],
+                        "title": rows[i]["title"],
+                        "url": rows[i]["url"],
+                        "snippet": rows[i]["text"][:300],
+                    }
+                    for i in kept
+                )
+    matrix = np.concatenate(blocks) if blocks else np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    if stamp is not None:
+        _MATRIX_CACHE.update(stamp=stamp, matrix=matrix, meta=meta)
+    return matrix, meta
+
 
+def _embeddings_stamp() -> Tuple[Any, ...] | None:
+    """Cheap fingerprint of the embeddings table: newest row plus local ingests.
 
+    Re-ingesting a document deletes and re-inserts its embeddings, which moves
+    max(created_at), so no full-table count is needed.
+    """
+    with db.get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("select max(e.created_at) as latest from embeddings e")
+            row = cur.fetchone()
+    if not row:
+        return None
+    return (db.get_corpus_version(), row["latest"])
@@ -1,58 +1,90 @@
 from typing import Any, Dict, List
+import functools
 import re
 from collections import defaultdict
 
+try:
+    import ahocorasick
+except ImportError:
+    # Optional speedup; categorize_document falls back to per-keyword scans
+    ahocorasick = None
+
+
+# Category keyword patterns
+CATEGORIES = {
+    "Implementation Guides": [
+        "implementation", "setup", "install", "configuration", "deployment",
+        "getting started", "quick start", "tutorial", "guide", "how to"
+    ],
+    "Best Practices": [
+        "best practice", "recommendation", "guideline", "standard",
+        "policy", "procedure", "methodology", "approach"
+    ],
+    "Evaluation & Metrics": [
+        "evaluation", "assessment", "metrics", "measurement", "kpi",
+        "performance", "effectiveness", "analysis", "testing"
+    ],
+    "Use Cases": [
+        "use case", "scenario", "example", "case study", "application",
+        "workflow", "process", "business case"
+    ],
+    "Technical Documentation": [
+        "api", "technical", "specification", "architecture", "design",
+        "system", "integration", "development", "code"
+    ],
+    "Research & Studies": [
+        "research", "study", "paper", "analysis", "findings",
+        "survey", "report", "investigation", "experiment"
+    ],
+    "Training & Education": [
+        "training", "education", "learning", "course", "workshop",
+        "certification", "tutorial", "lesson", "module"
+    ],
+    "Policies & Compliance": [
+        "policy", "compliance", "regulation", "standard", "requirement",
+        "governance", "audit", "security", "privacy"
+    ]
+}
+
+
+def _build_keyword_automaton():
+    """Build an Aho-Corasick automaton mapping each keyword to the categories that use it"""
+    if ahocorasick is None:
+        return None
+    keyword_categories: Dict[str, List[str]] = defaultdict(list)
+    for category, keywords in CATEGORIES.items():
+        for keyword in keywords:
+            keyword_categories[keyword].append(category)
+    automaton = ahocorasick.Automaton()
+    for keyword, categories in keyword_categories.items():
+        automaton.add_word(keyword, tuple(categories))
+    automaton.make_automaton()
+    return automaton
+
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
 
 def categorize_document(title: str, snippet: str = "") -> str:
     """Categorize a document based on its title and content"""
-    title_lower = title.lower()
-    snippet_lower = snippet.lower()
-    content = f"{title_lower} {snippet_lower}"
-    
-    # Define category patterns
-    categories = {
-        "Implementation Guides": [
-            "implementation", "setup", "install", "configuration", "deployment",
-            "getting started", "quick start", "tutorial", "guide", "how to"
-        ],
-        "Best Practices": [
-            "best practice", "recommendation", "guideline", "standard",
-            "policy", "procedure", "methodology", "approach"
-        ],
-        "Evaluation & Metrics": [
-            "evaluation", "assessment", "metrics", "measurement", "kpi",
-            "performance", "effectiveness", "analysis", "testing"
-        ],
-        "Use Cases": [
-            "use case", "scenario", "example", "case study", "application",
-            "workflow", "process", "business case"
-        ],
-        "Technical Documentation": [
-            "api", "technical", "specification", "architecture", "design",
-            "system", "integration", "development", "code"
-        ],
-        "Research & Studies": [
-            "research", "study", "paper", "analysis", "findings",
-            "survey", "report", "investigation", "experiment"
-        ],
-        "Training & Education": [
-            "training", "education", "learning", "course", "workshop",
-            "certification", "tutorial", "lesson", "module"
-        ],
-        "Policies & Compliance": [
-            "policy", "compliance", "regulation", "standard", "requirement",
-            "governance", "audit", "security", "privacy"
-        ]
-    }
-    
+    return _categorize_content(f"{title} {snippet}".lower())
+
+
+@functools.lru_cache(maxsize=8192)
+def _categorize_content(content: str) -> str:
+    """Categorization is a pure function of the lowercased content, and the same
+    documents come back across queries, so results are memoized on it."""
     # Score each category based on keyword matches
-    category_scores = {}
-    for category, keywords in categories.items():
-        score = 0
-        for keyword in keywords:
-            if keyword in content:
-                score += content.count(keyword)
-        category_scores[category] = score
+    category_scores = dict.fromkeys(CATEGORIES, 0)
+    if _KEYWORD_AUTOMATON is not None:
+        # One pass over the content finds every keyword occurrence for every category
+        for _, categories in _KEYWORD_AUTOMATON.iter(content):
+            for category in categories:
+                category_scores[category] += 1
+    else:
+        # count() already returns 0 for absent keywords, so one scan per keyword is enough
+        for category, keywords in CATEGORIES.items():
+            category_scores[category] = sum(content.count(keyword) for keyword in keywords)
     
     # Return the category with the highest score, or "General" if no clear match
     if category_scores and max(category_scores.values()) > 0:
@@ -61,46 +93,29 @@ def categorize_document(title: str, snippet: str = "") -> str:
         return "General Documents"
 
 
-def group_documents_by_category(sources: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
-    """Group documents by their determined categories"""
-    grouped = defaultdict(list)
-    
-    for source in sources:
-        title = source.get("title", "")
-        snippet = source.get("snippet", "")
-        category = categorize_document(title, snippet)
-        grouped[category].append(source)
-    
-    return dict(grouped)
-
-
 async def run_node(inputs: Dict[str, Any]) -> Dict[str, Any]:
     results: List[Dict[str, Any]] = inputs.get("results", [])
     sources = []
+    grouped_sources = defaultdict(list)
     
-    # Process all results into sources
+    # Build each source and file it under its category in the same pass
     for r in results:
-        sources.append({
+        source = {
             "title": r.get("title") or r.get("url") or "Document",
             "url": r.get("url"),
             "snippet": r.get("snippet")
-        })
-    
-    # Group documents by category
-    grouped_sources = group_documents_by_category(sources)
+        }
+        sources.append(source)
+        grouped_sources[categorize_document(source["title"], source["snippet"] or "")].append(source)
     
     # Create a summary of grouped sources
-    grouped_summary = {}
-    for category, docs in grouped_sources.items():
-        grouped_summary[category] = {
-            "count": len(docs),
-            "documents": docs
-        }
+    grouped_summary = {
+        category: {"count": len(docs), "documents": docs}
+        for category, docs in grouped_sources.items()
+    }
     
     return {
         "sources": sources,  # Keep original flat list for backward compatibility
         "grouped_sources": grouped_summary,  # New grouped structure
         "results": results
     }
-
-
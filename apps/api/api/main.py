@@ -1,10 +1,23 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import os
 from pathlib import Path
 from dotenv import load_dotenv
 
+from api.agents.nodes.answer_generation_node import warm_encoder
 from api.routes import admin, ingest, search
+from api.services.openai_client import close_openai_clients
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fetch the tokenizer in the background so no request waits on its download
+    warm_encoder()
+    yield
+    # Every request shares the process-wide OpenAI connection pools; release them on shutdown
+    await close_openai_clients()
 
 
 def create_app() -> FastAPI:
@@ -15,7 +28,8 @@ def create_app() -> FastAPI:
     if api_env.exists():
         load_dotenv(dotenv_path=api_env, override=True)
 
-    app = FastAPI(title="IKB Navigator API", version="0.1.0")
+    # orjson serializes the large sources/results payloads several times faster than json
+    app = FastAPI(title="IKB Navigator API", version="0.1.0", default_response_class=ORJSONResponse, lifespan=lifespan)
 
     cors_origin = os.getenv("CORS_ORIGIN", "*")
     app.add_middleware(
@@ -3,10 +3,10 @@ from pydantic import BaseModel
 
 from api.integrations.mcp_client import GDriveMCPClient
 from api.services import db
-from api.services.embedding import embed_texts
+from api.services.chunking import chunk_text, estimate_tokens
+from api.services.embedding import embed_texts_async
 import hashlib
 import os
-from typing import List
 
 router = APIRouter()
 
@@ -57,20 +57,14 @@ async def gdrive_sync(body: SyncRequest) -> dict:
                 document_id = doc_id_row["id"]
 
                 # Simple chunking (characters)
-                chunk_size = 2000
-                overlap = 200
-                chunks: List[str] = []
-                i = 0
-                while i < len(text):
-                    chunks.append(text[i : i + chunk_size])
-                    i += chunk_size - overlap
+                chunks = chunk_text(text)
 
                 # Insert chunks
                 cur.execute("delete from chunks where document_id=%s", (document_id,))
-                for idx, chunk_text in enumerate(chunks):
+                for idx, chunk in enumerate(chunks):
                     cur.execute(
                         "insert into chunks (document_id, chunk_index, text, token_count) values (%s, %s, %s, %s) returning id",
-                        (document_id, idx, chunk_text, len(chunk_text.split())),
+                        (document_id, idx, chunk, estimate_tokens(chunk)),
                     )
                 created += 1
 
@@ -80,7 +74,7 @@ async def gdrive_sync(body: SyncRequest) -> dict:
                 cur.execute("select id, text from chunks where document_id=%s order by chunk_index", (document_id,))
                 rows = cur.fetchall()
                 if rows:
-                    embeds = embed_texts([r["text"] for r in rows])
+                    embeds = await embed_texts_async([r["text"] for r in rows])
                     cur.execute("delete from embeddings where chunk_id = any(%s)", ([r["id"] for r in rows],))
                     for row, emb in zip(rows, embeds):
                         cur.execute(
@@ -89,6 +83,8 @@ async def gdrive_sync(body: SyncRequest) -> dict:
                         )
             conn.commit()
 
+    if created:
+        db.bump_corpus_version()
     return {"processed_documents": created}
 
 
@@ -1,7 +1,9 @@
 from fastapi import APIRouter
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+import orjson
 
-from api.agents.graph import run_pipeline
+from api.agents.graph import run_pipeline, stream_pipeline
 
 router = APIRouter()
 
@@ -16,3 +18,10 @@ async def search(body: SearchRequest) -> dict:
     return result
 
 
+@router.post("/search/stream")
+async def search_stream(body: SearchRequest) -> StreamingResponse:
+    async def events():
+        async for item in stream_pipeline(body.query):
+            yield f"event: {item['event']}\ndata: {orjson.dumps(item['data']).decode()}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
@@ -0,0 +1,15 @@
+from typing import List
+
+
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 200
+
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Split text into overlapping character windows"""
+    return [text[start : start + chunk_size] for start in range(0, len(text), chunk_size - overlap)]
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used for chunk metadata"""
+    return len(text) // 4
@@ -1,12 +1,27 @@
+import asyncio
 import os
-from typing import Any, Iterable, Sequence, Dict, List
+from typing import Any, Iterable, Sequence, Dict, List, Tuple
 from contextlib import contextmanager
 from pathlib import Path
 from dotenv import load_dotenv
+import numpy as np
 
 from supabase import create_client, Client
 
 
+# Bumped whenever documents are ingested so caches of search output can tell they are stale
+_CORPUS_VERSION = 0
+
+
+def get_corpus_version() -> int:
+    return _CORPUS_VERSION
+
+
+def bump_corpus_version() -> None:
+    global _CORPUS_VERSION
+    _CORPUS_VERSION += 1
+
+
 def _load_env_if_needed():
     """Load environment variables if not already loaded"""
     if not os.getenv("SUPABASE_URL"):
@@ -44,7 +59,10 @@ class SupabaseConnection:
         self.client = client
         self._cursor = None
     
-    def cursor(self):
+    def cursor(self, name: str | None = None):
+        if name is not None:
+            # Named cursors page through results, like a psycopg server-side cursor
+            return SupabaseCursor(self.client, name=name)
         if self._cursor is None:
             self._cursor = SupabaseCursor(self.client)
         return self._cursor
@@ -63,9 +81,13 @@ class SupabaseConnection:
 class SupabaseCursor:
     """A cursor-like interface for Supabase client"""
     
-    def __init__(self, client: Client):
+    def __init__(self, client: Client, name: str | None = None):
         self.client = client
+        self.name = name
+        self.itersize = 256
         self._last_result = None
+        # For named cursors: (query builder factory, next offset, row limit, row transform)
+        self._pager = None
     
     def __enter__(self):
         return self
@@ -112,31 +134,60 @@ class SupabaseCursor:
         
         if "select e.chunk_id, e.embedding" in sql.lower() and "from embeddings e" in sql.lower():
             # Handle the search query from search_node.py
-            try:
-                result = self.client.table('embeddings') \
+            def search_query():
+                # Order by the primary key so LIMIT/OFFSET pages never repeat or skip rows
+                return self.client.table('embeddings') \
                     .select('chunk_id, embedding, chunks!inner(text, documents!inner(title, url))') \
-                    .limit(2000) \
-                    .execute()
-                
-                # Transform the result to match expected format
-                transformed_rows = []
-                for row in result.data:
-                    chunks_data = row.get('chunks')
-                    if chunks_data and chunks_data.get('documents'):
-                        transformed_rows.append({
-                            'chunk_id': row['chunk_id'],
-                            'embedding': row['embedding'],
-                            'text': chunks_data['text'],
-                            'title': chunks_data['documents']['title'],
-                            'url': chunks_data['documents']['url']
-                        })
-                self._last_result = transformed_rows
+                    .order('id')
+            
+            if self.name is not None:
+                # Fetched page by page in fetchmany()
+                self._pager = [search_query, 0, 2000, _transform_search_rows]
+                self._last_result = []
+                return
+            try:
+                result = search_query().limit(2000).execute()
+                self._last_result = _transform_search_rows(result.data)
             except Exception as e:
                 print(f"Error executing search query: {e}")
                 # Return empty result if no data or on error
                 self._last_result = []
             return
         
+        if "select max(e.created_at) as latest" in sql.lower() and "from embeddings e" in sql.lower():
+            # Handle the embeddings change stamp used to validate cached search matrices;
+            # reads one index-ordered row, with no table count
+            try:
+                result = self.client.table('embeddings') \
+                    .select('created_at') \
+                    .order('created_at', desc=True) \
+                    .limit(1) \
+                    .execute()
+                latest = result.data[0]['created_at'] if result.data else None
+                self._last_result = [{'latest': latest}]
+            except Exception as e:
+                print(f"Error reading embeddings stamp: {e}")
+                self._last_result = []
+            return
+        
+        if "from embeddings e" in sql.lower() and "order by e.embedding <=>" in sql.lower():
+            # Handle the pgvector nearest-neighbour search via the match_chunks RPC
+            try:
+                params = params or []
+                if len(params) >= 3:
+                    query_vector, _, match_count = params
+                    result = self.client.rpc('match_chunks', {
+                        'query_embedding': query_vector,
+                        'match_count': match_count
+                    }).execute()
+                    self._last_result = result.data or []
+                else:
+                    self._last_result = []
+            except Exception as e:
+                print(f"Error executing vector search: {e}")
+                self._last_result = []
+            return
+        
         if "insert into documents" in sql.lower() and "on conflict" in sql.lower():
             # Handle document insertion with upsert
             try:
@@ -328,14 +379,154 @@ class SupabaseCursor:
         raise NotImplementedError("executemany not yet implemented for Supabase")
     
     def fetchall(self):
+        if self._pager is not None:
+            rows = []
+            while True:
+                page = self.fetchmany(self.itersize)
+                if not page:
+                    return rows
+                rows.extend(page)
         return self._last_result or []
     
+    def fetchmany(self, size: int | None = None):
+        size = size or self.itersize
+        if self._pager is None:
+            rows = (self._last_result or [])[:size]
+            self._last_result = (self._last_result or [])[size:]
+            return rows
+        query_factory, offset, limit, transform = self._pager
+        while offset < limit:
+            end = min(offset + size, limit) - 1
+            try:
+                result = query_factory().range(offset, end).execute()
+            except Exception as e:
+                print(f"Error fetching rows {offset}-{end}: {e}")
+                self._pager[1] = limit
+                return []
+            data = result.data or []
+            # A short page means the table is exhausted
+            offset = end + 1 if len(data) == end - offset + 1 else limit
+            self._pager[1] = offset
+            rows = transform(data)
+            if rows:
+                return rows
+        return []
+    
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+    
     def fetchone(self):
         if self._last_result and len(self._last_result) > 0:
             return self._last_result[0]
         return None
 
 
+def _transform_search_rows(data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Flatten embeddings joined to chunks/documents into search rows"""
+    transformed_rows = []
+    for row in data:
+        chunks_data = row.get('chunks')
+        if chunks_data and chunks_data.get('documents'):
+            transformed_rows.append({
+                'chunk_id': row['chunk_id'],
+                'embedding': row['embedding'],
+                'text': chunks_data['text'],
+                'title': chunks_data['documents']['title'],
+                'url': chunks_data['documents']['url']
+            })
+    return transformed_rows
+
+
+def parse_vector(value: Any) -> np.ndarray | None:
+    """Decode a pgvector value into a float32 array.
+
+    PostgREST returns ``vector`` columns in pgvector's text form (``"[0.1,0.2,...]"``),
+    which numpy can parse directly without building an intermediate list of floats.
+    Returns None for values that can't be decoded.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        vector = np.fromstring(value.strip().strip("[]"), dtype=np.float32, sep=",")
+    else:
+        try:
+            vector = np.asarray(value, dtype=np.float32)
+        except (TypeError, ValueError):
+            return None
+    if vector.ndim != 1 or vector.size == 0:
+        return None
+    return vector
+
+
+def parse_vectors(values: Sequence[Any], dim: int) -> Tuple[np.ndarray, List[int]]:
+    """Decode many pgvector values of dimension ``dim`` into one float32 matrix.
+
+    Returns the ``(n, dim)`` matrix and the indexes of the values it holds, skipping
+    values that can't be decoded or have another dimension. When every value is
+    pgvector text, they are joined and parsed with a single numpy call.
+    """
+    if values and all(isinstance(v, str) for v in values):
+        joined = ",".join(v.strip().strip("[]") for v in values)
+        flat = np.fromstring(joined, dtype=np.float32, sep=",")
+        if flat.size == len(values) * dim:
+            return flat.reshape(len(values), dim), list(range(len(values)))
+    # Mixed formats or a malformed row somewhere: decode row by row
+    kept: List[int] = []
+    vectors: List[np.ndarray] = []
+    for i, value in enumerate(values):
+        vector = parse_vector(value)
+        if vector is not None and vector.shape[0] == dim:
+            kept.append(i)
+            vectors.append(vector)
+    if not vectors:
+        return np.empty((0, dim), dtype=np.float32), []
+    return np.stack(vectors), kept
+
+
+def format_vector(vector: Sequence[float]) -> str:
+    """Encode a vector in pgvector's text form, the inverse of parse_vector"""
+    return "[" + ",".join(str(float(x)) for x in vector) + "]"
+
+
+def match_chunks(query_embedding: Sequence[float], match_count: int) -> List[Dict[str, Any]]:
+    """Rank chunks by cosine distance in pgvector and return the best ``match_count``.
+
+    Rows carry chunk_id, title, url, text and a float cosine score. Returns an
+    empty list when the match_chunks function isn't installed or the call fails.
+    """
+    query_vector = format_vector(query_embedding)
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                select e.chunk_id, d.title, d.url, c.text, 1 - (e.embedding <=> %s::vector) as score
+                from embeddings e
+                join chunks c on c.id = e.chunk_id
+                join documents d on d.id = c.document_id
+                order by e.embedding <=> %s::vector
+                limit %s
+            """, (query_vector, query_vector, match_count))
+            rows = cur.fetchall()
+    return [{**r, "score": float(r["score"])} for r in rows]
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indexes of the ``k`` highest scores, best first, without sorting every score"""
+    if len(scores) > k:
+        top_idx = np.argpartition(scores, -k)[-k:]
+    else:
+        top_idx = np.arange(len(scores))
+    return top_idx[np.argsort(scores[top_idx])[::-1]]
+
+
+async def run_query(query: Any) -> Any:
+    """Run a Supabase query builder's blocking execute() in a worker thread"""
+    return await asyncio.to_thread(query.execute)
+
+
 def get_connection() -> SupabaseConnection:
     """Returns a connection-like wrapper around Supabase client"""
     client = get_supabase_client()
@@ -1,21 +1,64 @@
+import asyncio
 import os
-from typing import List
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple
 
 import numpy as np
-from openai import OpenAI
+
+from api.services.openai_client import get_async_openai_client, get_openai_client
 
 
 MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+QUERY_CACHE_SIZE = 1024
+EMBED_BATCH_SIZE = 100
+
+# Cache misses arriving within QUERY_BATCH_WINDOW seconds share one embeddings request
+QUERY_BATCH_WINDOW = 0.005
+QUERY_BATCH_MAX = 64
+
+_QUERY_EMB_CACHE: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_QUERY_EMB_PENDING: Dict[str, asyncio.Event] = {}
+_QUERY_BATCH: List[Tuple[str, "asyncio.Future[np.ndarray]"]] = []
+_QUERY_BATCH_TIMER: asyncio.TimerHandle | None = None
+_QUERY_BATCH_TASKS: Set[asyncio.Task] = set()
 
 
 def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embed texts as unit-length vectors, so cosine similarity is a plain dot product"""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         # Fallback: simple hashing-based pseudo-embedding for local dev without API key
         return [_hash_embed(t) for t in texts]
-    client = OpenAI(api_key=api_key)
-    resp = client.embeddings.create(model=MODEL, input=texts)
-    return [d.embedding for d in resp.data]
+    client = get_openai_client(api_key)
+    # Stay under the per-request input limits by sending large inputs in batches
+    embeddings: List[List[float]] = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        resp = client.embeddings.create(model=MODEL, input=texts[start:start + EMBED_BATCH_SIZE])
+        embeddings.extend(d.embedding for d in resp.data)
+    return normalize_embeddings(embeddings)
+
+
+async def embed_texts_async(texts: List[str]) -> List[List[float]]:
+    """Async variant of embed_texts that doesn't block the event loop"""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return [_hash_embed(t) for t in texts]
+    client = get_async_openai_client(api_key)
+    embeddings: List[List[float]] = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        resp = await client.embeddings.create(model=MODEL, input=texts[start:start + EMBED_BATCH_SIZE])
+        embeddings.extend(d.embedding for d in resp.data)
+    return normalize_embeddings(embeddings)
+
+
+def normalize_embeddings(embeddings: List[List[float]]) -> List[List[float]]:
+    """Scale each vector to unit L2 norm (zero vectors are left as-is)"""
+    if not embeddings:
+        return []
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).tolist()
 
 
 def _hash_embed(text: str, dim: int = 1536) -> List[float]:
@@ -25,3 +68,66 @@ def _hash_embed(text: str, dim: int = 1536) -> List[float]:
     return (vec / (norm if norm != 0 else 1.0)).astype(float).tolist()
 
 
+async def get_query_embedding(query: str) -> np.ndarray:
+    """Embed a search query, reusing recent results and coalescing concurrent misses"""
+    while True:
+        cached = _QUERY_EMB_CACHE.get(query)
+        if cached is not None:
+            _QUERY_EMB_CACHE.move_to_end(query)
+            return cached
+        pending = _QUERY_EMB_PENDING.get(query)
+        if pending is None:
+            break
+        # Another request is already embedding this query; wait for it and re-check
+        await pending.wait()
+
+    event = asyncio.Event()
+    _QUERY_EMB_PENDING[query] = event
+    try:
+        vector = await _embed_query_batched(query)
+        _QUERY_EMB_CACHE[query] = vector
+        if len(_QUERY_EMB_CACHE) > QUERY_CACHE_SIZE:
+            _QUERY_EMB_CACHE.popitem(last=False)
+        return vector
+    finally:
+        del _QUERY_EMB_PENDING[query]
+        event.set()
+
+
+async def _embed_query_batched(query: str) -> np.ndarray:
+    """Queue a query for the next batched embeddings request and wait for its vector"""
+    global _QUERY_BATCH_TIMER
+    loop = asyncio.get_running_loop()
+    future: "asyncio.Future[np.ndarray]" = loop.create_future()
+    _QUERY_BATCH.append((query, future))
+    if len(_QUERY_BATCH) >= QUERY_BATCH_MAX:
+        _flush_query_batch()
+    elif _QUERY_BATCH_TIMER is None:
+        _QUERY_BATCH_TIMER = loop.call_later(QUERY_BATCH_WINDOW, _flush_query_batch)
+    return await future
+
+
+def _flush_query_batch() -> None:
+    global _QUERY_BATCH, _QUERY_BATCH_TIMER
+    if _QUERY_BATCH_TIMER is not None:
+        _QUERY_BATCH_TIMER.cancel()
+        _QUERY_BATCH_TIMER = None
+    batch, _QUERY_BATCH = _QUERY_BATCH, []
+    if batch:
+        task = asyncio.get_running_loop().create_task(_embed_query_batch(batch))
+        # Keep a reference so the task isn't garbage collected mid-flight
+        _QUERY_BATCH_TASKS.add(task)
+        task.add_done_callback(_QUERY_BATCH_TASKS.discard)
+
+
+async def _embed_query_batch(batch: List[Tuple[str, "asyncio.Future[np.ndarray]"]]) -> None:
+    try:
+        embeddings = await embed_texts_async([query for query, _ in batch])
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), embedding in zip(batch, embeddings):
+        if not future.done():
+            future.set_result(np.asarray(embedding, dtype=np.float32))
@@ -0,0 +1,198 @@
+import asyncio
+import importlib.util
+import os
+import threading
+import time
+from typing import Any, Dict, Tuple
+
+import httpx
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
+
+
+OPENAI_TIMEOUT = 30.0
+OPENAI_MAX_RETRIES = 2
+
+# Keep connections alive between calls; with h2 installed, concurrent calls also
+# multiplex over one TLS connection instead of each opening their own
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+_HTTP_TIMEOUT = httpx.Timeout(OPENAI_TIMEOUT, connect=3.0)
+_HTTP2 = importlib.util.find_spec("h2") is not None
+
+CHAT_MAX_ATTEMPTS = 4
+# Upper bound on any single retry wait, including a server-sent Retry-After
+CHAT_MAX_BACKOFF = 20.0
+# Same statuses the SDK itself retries: timeout, lock conflict, rate limit, server errors
+_RETRYABLE_STATUSES = frozenset({408, 409, 429})
+
+# One client per (kind, api key) for the whole process, so HTTP connections are reused
+_CLIENTS: Dict[Tuple[str, str], object] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_openai_client(api_key: str | None = None) -> OpenAI:
+    """Return the process-wide synchronous OpenAI client"""
+    return _get_client("sync", api_key or os.getenv("OPENAI_API_KEY") or "")
+
+
+def get_async_openai_client(api_key: str | None = None) -> AsyncOpenAI:
+    """Return the process-wide asynchronous OpenAI client"""
+    return _get_client("async", api_key or os.getenv("OPENAI_API_KEY") or "")
+
+
+class _TokenBucket:
+    """Throttle chat requests to the account's requests/tokens per minute.
+
+    Requests wait at submit time while the bucket refills, rather than bursting
+    past the limit and coming back as 429s. A limit of 0 is not enforced.
+    """
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock: asyncio.Lock | None = None
+
+    def set_limits(self, rpm: int, tpm: int) -> None:
+        self.rpm, self.tpm = rpm, tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+
+    async def acquire(self, tokens: int) -> None:
+        if not self.rpm and not self.tpm:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self._updated
+                self._updated = now
+                self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+                self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+                # A request larger than the whole budget can only wait for a full bucket
+                needed = min(tokens, self.tpm)
+                wait = 0.0
+                if self.rpm and self._requests < 1:
+                    wait = (1 - self._requests) * 60 / self.rpm
+                if self.tpm and self._tokens < needed:
+                    wait = max(wait, (needed - self._tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    self._requests -= 1 if self.rpm else 0
+                    self._tokens -= needed if self.tpm else 0
+                    return
+                await asyncio.sleep(wait)
+
+
+_CHAT_BUCKET: _TokenBucket | None = None
+_LIMITS_KNOWN = False
+
+
+def _chat_bucket() -> _TokenBucket:
+    """Create the limiter on first use, after .env has been loaded.
+
+    OPENAI_RPM/OPENAI_TPM set the account limits; left at 0 they are learned from
+    the first response's headers.
+    """
+    global _CHAT_BUCKET, _LIMITS_KNOWN
+    if _CHAT_BUCKET is None:
+        rpm = int(os.getenv("OPENAI_RPM", "0"))
+        tpm = int(os.getenv("OPENAI_TPM", "0"))
+        _CHAT_BUCKET = _TokenBucket(rpm, tpm)
+        _LIMITS_KNOWN = bool(rpm or tpm)
+    return _CHAT_BUCKET
+
+
+async def create_chat_completion(estimated_tokens: int, **kwargs: Any) -> Any:
+    """chat.completions.create on the shared client, rate limited and retried.
+
+    ``estimated_tokens`` (prompt plus max_tokens) is charged against the TPM budget.
+    Connection errors, timeouts, 408/409/429 and 5xx are retried with exponential
+    backoff, honouring the server's Retry-After when it sends one.
+    """
+    global _LIMITS_KNOWN
+    client = _get_chat_client()
+    bucket = _chat_bucket()
+    for attempt in range(CHAT_MAX_ATTEMPTS):
+        await bucket.acquire(estimated_tokens)
+        try:
+            raw = await client.chat.completions.with_raw_response.create(**kwargs)
+        except (APIConnectionError, APIStatusError) as e:
+            # APIConnectionError covers APITimeoutError; status errors carry a code
+            status = e.status_code if isinstance(e, APIStatusError) else None
+            retryable = status is None or status in _RETRYABLE_STATUSES or status >= 500
+            if not retryable or attempt == CHAT_MAX_ATTEMPTS - 1:
+                raise
+            retry_after = e.response.headers.get("retry-after") if status is not None else None
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = 2.0 ** attempt
+            if not delay >= 0:
+                # Negative or NaN header value
+                delay = 2.0 ** attempt
+            # A huge or bogus Retry-After must not stall the request indefinitely
+            delay = min(delay, CHAT_MAX_BACKOFF)
+            print(f"OpenAI call failed ({status or type(e).__name__}), retrying in {delay:.1f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+            continue
+        if not _LIMITS_KNOWN:
+            _LIMITS_KNOWN = True
+            rpm = raw.headers.get("x-ratelimit-limit-requests")
+            tpm = raw.headers.get("x-ratelimit-limit-tokens")
+            if rpm and tpm and rpm.isdigit() and tpm.isdigit():
+                bucket.set_limits(int(rpm), int(tpm))
+        return raw.parse()
+
+
+def _get_chat_client() -> AsyncOpenAI:
+    """The shared async client with SDK retries off, so retries go through the rate limiter"""
+    api_key = os.getenv("OPENAI_API_KEY") or ""
+    key = ("async-chat", api_key)
+    client = _CLIENTS.get(key)
+    if client is None:
+        # Fetch the base client before taking the (non-reentrant) lock
+        base = get_async_openai_client(api_key)
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.setdefault(key, base.with_options(max_retries=0))
+    return client
+
+
+async def close_openai_clients() -> None:
+    """Close the shared clients' connection pools; called once on app shutdown"""
+    with _CLIENTS_LOCK:
+        # The chat client is a copy sharing the async client's pool, which is closed below
+        clients = [client for (kind, _), client in _CLIENTS.items() if kind != "async-chat"]
+        _CLIENTS.clear()
+    for client in clients:
+        if isinstance(client, AsyncOpenAI):
+            await client.close()
+        else:
+            client.close()
+
+
+def _get_client(kind: str, api_key: str):
+    key = (kind, api_key)
+    client = _CLIENTS.get(key)
+    if client is None:
+        # Embedding calls run in worker threads, so guard creation
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                if kind == "sync":
+                    http_client = DefaultHttpxClient(http2=_HTTP2, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+                    client = OpenAI(api_key=api_key, max_retries=OPENAI_MAX_RETRIES, http_client=http_client)
+                else:
+                    http_client = DefaultAsyncHttpxClient(http2=_HTTP2, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+                    client = AsyncOpenAI(api_key=api_key, max_retries=OPENAI_MAX_RETRIES, http_client=http_client)
+                _CLIENTS[key] = client
+    return client
@@ -0,0 +1,72 @@
+import time
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """Cache values by embedding similarity, so paraphrased queries can reuse earlier work.
+
+    Keys are embedding vectors; a lookup hits when the closest stored key has cosine
+    similarity of at least ``threshold``. Entries expire after ``ttl`` seconds, are
+    evicted least-recently-used once ``maxsize`` is reached, and only match lookups
+    made with the same ``version`` (e.g. the corpus version) they were stored under.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 900.0, threshold: float = 0.95) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._matrix: Optional[np.ndarray] = None
+        self._valid = np.zeros(maxsize, dtype=bool)
+        # Per slot: (stored_at, last_used, version, value)
+        self._entries: List[Optional[Tuple[float, float, int, Any]]] = [None] * maxsize
+
+    def clear(self) -> None:
+        self._matrix = None
+        self._valid[:] = False
+        self._entries = [None] * self.maxsize
+
+    def lookup(self, vector: np.ndarray, version: int = 0) -> Any:
+        """Return the value stored under the most similar key, or None on a miss"""
+        if self._matrix is None or not self._valid.any():
+            return None
+        query = self._normalize(vector)
+        if query.shape[0] != self._matrix.shape[1]:
+            return None
+        scores = np.where(self._valid, self._matrix @ query, -np.inf)
+        slot = int(np.argmax(scores))
+        if scores[slot] < self.threshold:
+            return None
+        stored_at, _, entry_version, value = self._entries[slot]
+        now = time.monotonic()
+        if entry_version != version or now - stored_at > self.ttl:
+            self._evict(slot)
+            return None
+        self._entries[slot] = (stored_at, now, entry_version, value)
+        return value
+
+    def store(self, vector: np.ndarray, value: Any, version: int = 0) -> None:
+        key = self._normalize(vector)
+        if self._matrix is None or self._matrix.shape[1] != key.shape[0]:
+            # First entry, or the embedding model changed dimension: start over
+            self.clear()
+            self._matrix = np.zeros((self.maxsize, key.shape[0]), dtype=np.float32)
+        free = np.flatnonzero(~self._valid)
+        if free.size:
+            slot = int(free[0])
+        else:
+            slot = min(range(self.maxsize), key=lambda i: self._entries[i][1])
+        now = time.monotonic()
+        self._matrix[slot] = key
+        self._valid[slot] = True
+        self._entries[slot] = (now, now, version, value)
+
+    def _evict(self, slot: int) -> None:
+        self._valid[slot] = False
+        self._entries[slot] = None
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.sqrt(np.vdot(vector, vector)) + 1e-12)
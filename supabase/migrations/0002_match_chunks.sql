@@ -0,0 +1,49 @@
+-- Nearest-neighbour search over chunk embeddings, ranked inside Postgres.
+-- Used by api/agents/nodes/hybrid_search_node.py (vector_search_database).
+--
+-- An HNSW index scan returns at most hnsw.ef_search rows (default 40), so
+-- match_chunks() raises ef_search to match_count for its own transaction.
+-- ef_search is capped at 1000: match_count must not exceed that.
+
+create extension if not exists vector;
+
+-- The index and function below need a vector(1536) column. Deployments that stored
+-- embeddings as text/json are converted first; an existing vector(1536) column is
+-- left alone, so the normal path doesn't rewrite the table.
+do $$
+begin
+  if (select format_type(a.atttypid, a.atttypmod)
+      from pg_attribute a
+      where a.attrelid = 'embeddings'::regclass and a.attname = 'embedding')
+     is distinct from 'vector(1536)' then
+    alter table embeddings
+      alter column embedding type vector(1536) using embedding::text::vector(1536);
+  end if;
+end
+$$;
+
+create index if not exists embeddings_embedding_hnsw_idx
+  on embeddings using hnsw (embedding vector_cosine_ops);
+
+create or replace function match_chunks(query_embedding vector(1536), match_count int default 100)
+returns table (
+  chunk_id uuid,
+  title text,
+  url text,
+  text text,
+  score float8
+)
+language plpgsql stable
+as $$
+#variable_conflict use_column
+begin
+  perform set_config('hnsw.ef_search', least(greatest(match_count, 40), 1000)::text, true);
+  return query
+    select e.chunk_id, d.title, d.url, c.text, (1 - (e.embedding <=> query_embedding))::float8 as score
+    from embeddings e
+    join chunks c on c.id = e.chunk_id
+    join documents d on d.id = c.document_id
+    order by e.embedding <=> query_embedding
+    limit match_count;
+end;
+$$;
@@ -0,0 +1,10 @@
+-- Natural keys for chunks and embeddings, so a document never holds two chunks
+-- at the same index and a chunk never holds two vectors.
+-- Ingestion does not depend on them: hybrid_search_node.py only ever inserts
+-- rows for a newly created document.
+
+create unique index if not exists chunks_document_id_chunk_index_key
+  on chunks (document_id, chunk_index);
+
+create unique index if not exists embeddings_chunk_id_key
+  on embeddings (chunk_id);
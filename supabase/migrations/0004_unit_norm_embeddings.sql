@@ -0,0 +1,5 @@
+-- Embeddings are stored L2-normalized (see api/services/embedding.py embed_texts),
+-- so cosine similarity against a normalized query is a plain inner product.
+
+comment on column embeddings.embedding is
+  'L2-normalized (unit length) embedding; cosine similarity = inner product';
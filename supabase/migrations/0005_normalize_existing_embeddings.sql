@@ -0,0 +1,7 @@
+-- Backfill: rescale any embeddings written before embed_texts normalized its output,
+-- so every stored vector is unit length as documented in 0004.
+-- Requires pgvector 0.7.0+ for l2_normalize().
+
+update embeddings
+set embedding = l2_normalize(embedding)
+where abs(vector_norm(embedding) - 1) > 1e-4;